@@ -6,8 +6,11 @@ setup(
     license="BSD-2-Clause",
     install_requires=[
         "pymongo==4.2.0",
-        "urllib3==1.26.12"
+        "urllib3>=1.26.12,<3"
     ],
+    extras_require={
+        "fast": ["orjson", "brotli", "ciso8601", "zstandard"]
+    },
     package_dir={'wanikani_api': 'wanikani_api'},
     packages=["wanikani_api"],
     py_modules=["wanikani_api"]
@@ -1,16 +1,56 @@
 from __future__ import annotations
 
+import atexit
+import copy
 import json
-from time import sleep
+import re
+from time import sleep, monotonic, time
 from typing import AnyStr, Union, Iterable, Dict, List
-from datetime import datetime, timedelta
+from datetime import datetime
 from os import environ
-from urllib.parse import quote
-from collections import deque
+from urllib.parse import quote, urlsplit
+from threading import Lock
+from collections import OrderedDict
+from functools import lru_cache, partial
+from importlib.util import find_spec
 
 import urllib3
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel, InsertOne, UpdateOne, ReturnDocument, ASCENDING
 from urllib3.exceptions import HTTPError
+from urllib3.util import Retry, make_headers
+
+try:
+    # The API returns UTC timestamps which are cached as naive datetimes
+    from ciso8601 import parse_datetime_as_naive as _parse_dt
+except ImportError:
+    def _parse_dt(value: str) -> datetime:
+        # Only the trailing Z needs stripping, which also keeps the result
+        # naive on 3.11+ where fromisoformat would return an aware datetime
+        return datetime.fromisoformat(value[:-1] if value[-1] == "Z" else value)
+
+try:
+    # orjson works on bytes directly and is several times faster than the
+    # standard library on the large subject pages
+    from orjson import loads as _loads, dumps as _dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+API_HOST = "api.wanikani.com"
+API_REVISION = "20170710"
+SUMMARY_TTL = 300
+USER_TTL = 300
+SUBJECT_LRU_SIZE = 4096
+# Cached collections are usually read in full, so fewer larger getMore batches
+CACHE_BATCH_SIZE = 1000
+# gzip and deflate, plus br when brotli is installed. urllib3 decodes the
+# responses transparently
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+
+IdArg = Union[int, Iterable[int], None]
+DateArg = Union[datetime, str, None]
 
 
 class WanikaniApiBaseException(Exception):
@@ -38,22 +78,93 @@ class WanikaniRequestError(WanikaniApiBaseException):
 
 
 class RateLimiter:
-    def __init__(self):
-        self.requests = deque()
+    # Token bucket for WaniKani's limit of 60 requests per minute for each token.
+    # A full bucket plus a minute of refill must stay within that limit, so
+    # the burst is 10 and the refill 50 per minute. All handles for a token
+    # share one bucket, possibly from several threads, so the bucket is locked.
+    def __init__(self, capacity: int = 10, rate: float = 50 / 60):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.last = monotonic()
+        self._lock = Lock()
 
     def can_request(self) -> bool:
-        now = datetime.now()
-        while self.requests and now - self.requests[0] > timedelta(minutes=1):
-            self.requests.popleft()
-        if len(self.requests) >= 3:
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
             return False
-        self.requests.append(now)
-        return True
 
     def sleep_until_can_request(self):
-        if not self.can_request():
-            until = (self.requests[0] + timedelta(minutes=1)) - datetime.now()
-            sleep(until.seconds + until.microseconds / 1e6)
+        while not self.can_request():
+            sleep((1 - self.tokens) / self.rate)
+
+
+def _coerce_ids(ids: IdArg) -> Union[List[int], None]:
+    # Lists are by far the most common input so they are passed through as is,
+    # other iterables are materialized once so that they can be used both in
+    # the url and in the cache filter
+    if ids is None:
+        return None
+    t = type(ids)
+    if t is int:
+        return [ids]
+    if t is list:
+        return ids
+    return list(ids)
+
+
+def _to_dt(value: Union[datetime, str]) -> datetime:
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def _to_millis(value: Union[datetime, None]) -> Union[datetime, None]:
+    # BSON keeps datetimes to the millisecond, so values read back from Mongo
+    # only compare equal to API timestamps truncated the same way
+    if value is None:
+        return None
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+def _without_none(**kwargs) -> Dict:
+    return {k: v for k, v in kwargs.items() if v is not None}
+
+
+@lru_cache(maxsize=512)
+def _build_url(base_url: str, url_params: tuple) -> str:
+    # url_params are (key, value) pairs, where value None is a bare flag. Pollers
+    # repeat the same handful of queries so the built url is memoized.
+    if not url_params:
+        return base_url
+    query = '&'.join(k if v is None else f"{k}={quote(v, safe=',')}" for k, v in url_params)
+    return f"{base_url}?{query}"
+
+
+def _summary_ttl(headers) -> float:
+    # The summary only changes on the hour, or when the user does lessons and
+    # reviews through this handle, which clears it. A positive max-age sent by
+    # the API takes precedence over the default.
+    match = re.search(r"max-age=(\d+)", headers.get("Cache-Control", ""))
+    if match and int(match[1]) > 0:
+        return int(match[1])
+    return min(SUMMARY_TTL, 3600 - int(time()) % 3600)
+
+
+def _path(url: str) -> str:
+    # The connection pool is bound to the API host so only the path and the
+    # query are sent. Full urls are still used as the keys in the cache.
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def _mongo_compressors() -> List[str]:
+    # Cached subjects compress well on the wire, but pymongo warns about every
+    # compressor whose library is missing so only the installed ones are asked for
+    return [name for name, module in (("zstd", "zstandard"), ("snappy", "snappy")) if find_spec(module)]
 
 
 def _raise_error(request):
@@ -64,30 +175,194 @@ def _raise_error(request):
     raise WanikaniRequestError(request.status)
 
 
+# The date fields of each object type and field set, so the keys of a schema
+# only need scanning once. Documents of one type can differ in their optional
+# fields, so the whole key set is part of the cache key.
+_DATE_KEYS_BY_OBJECT: Dict[tuple, tuple] = {}
+
+
+def _date_keys(object_type: str, data: dict) -> tuple:
+    cache_key = (object_type, frozenset(data))
+    keys = _DATE_KEYS_BY_OBJECT.get(cache_key)
+    if keys is None:
+        keys = _DATE_KEYS_BY_OBJECT[cache_key] = tuple(k for k in data if k.endswith("_at"))
+    return keys
+
+
+# Handlers for the query parameters of the collection getters, each adds the
+# url parameter and the matching cache filter for its parameter
+
+
+def _parse_immediately_available_for_lessons(url_params, filter_params, is_assignment, now, param, value, kwargs):
+    url_params.append((param, None))
+    filter_params["data.unlocked_at"] = {"$lte": now}
+    filter_params["data.started_at"] = None
+
+
+def _parse_immediately_available_for_review(url_params, filter_params, is_assignment, now, param, value, kwargs):
+    url_params.append((param, None))
+    filter_params["data.available_at"] = {"$lte": now}
+
+
+def _parse_in_review(url_params, filter_params, is_assignment, now, param, value, kwargs):
+    url_params.append((param, None))
+    filter_params["data.available_at"] = {"$ne": None}
+
+
+def _parse_date(url_params, filter_params, is_assignment, now, param, value, kwargs):
+    value = _to_dt(value)
+    url_params.append((param, value.isoformat()))
+
+    if param == "updated_after":
+        filter_params["data_updated_at"] = {"$gte": value}
+    else:
+        # available_after and available_before combine into one range
+        op = "$gte" if param == "available_after" else "$lte"
+        filter_params.setdefault("data.available_at", {})[op] = value
+
+
+def _parse_percentage(url_params, filter_params, is_assignment, now, param, value, kwargs):
+    url_params.append((param, str(value)))
+    op = "$gt" if param == "percentages_greater_than" else "$lt"
+    filter_params.setdefault("data.percentage_correct", {})[op] = value
+
+
+def _parse_list_or_flag(url_params, filter_params, is_assignment, now, param, value, kwargs):
+    # bool is a subclass of int so the flags have to be handled first
+    if isinstance(value, bool):
+        url_params.append((param, str(value).lower()))
+        if is_assignment:
+            filter_params[f"data.{param}_at"] = {"$ne": None} if value else None
+        else:
+            filter_params[f"data.{param}"] = value
+        return
+
+    if param == "ids":
+        value = _coerce_ids(value)
+    elif isinstance(value, (str, int)):
+        value = [value]
+
+    url_params.append((param, ','.join(map(str, value))))
+    if param == "ids":
+        filter_params["id"] = {"$in": value}
+    elif param != "levels":
+        filter_params[f"data.{param[0:-1]}"] = {"$in": value}
+
+
+_QUERY_PARAMETER_HANDLERS = {
+    "immediately_available_for_lessons": _parse_immediately_available_for_lessons,
+    "immediately_available_for_review": _parse_immediately_available_for_review,
+    "in_review": _parse_in_review,
+    "available_after": _parse_date,
+    "available_before": _parse_date,
+    "updated_after": _parse_date,
+    "percentages_greater_than": _parse_percentage,
+    "percentages_less_than": _parse_percentage,
+}
+
+
 class UserHandle:
     mongodb_uri = environ.get("WANIKANI_API_MONGODB_URI") or "mongodb://localhost:27017"
-    mongo_client = MongoClient(mongodb_uri)
-    db = mongo_client["wanikani"]
-    rate_limiter = RateLimiter()
+    # The client is only created by the first handle so that importing the
+    # module doesn't start connecting to MongoDB
+    mongo_client = None
+    db = None
+    _db_lock = Lock()
+    # One bucket per token, as the API limits each token separately
+    _rate_limiters = {}
+    _rate_limiters_lock = Lock()
+    # Every request goes to the same host, so all handles share one pool and
+    # keep the connections to it alive between requests
+    _http = urllib3.HTTPSConnectionPool(
+        API_HOST,
+        maxsize=16,
+        block=False,
+        # Only the idempotent GETs are retried, and the last response is returned
+        # instead of raising MaxRetryError so that it reaches _raise_error
+        retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False
+        )
+    )
+    # create_indexes is idempotent but still a round trip, so it is only done
+    # once per process for each collection
+    _indexed_collections = set()
+    # Creating a handle for an already seen token doesn't need to go to Mongo,
+    # entries are (user, expiry) so that other processes' updates are picked up
+    _user_by_token = {}
+    _personal_caches = {}
+    # Subjects by id as (ETag of the response they came from, subject)
+    _subject_lru = OrderedDict()
+    _subject_lru_lock = Lock()
+
+    @classmethod
+    def _get_db(cls):
+        with cls._db_lock:
+            if cls.db is None:
+                cls.mongo_client = MongoClient(cls.mongodb_uri,
+                                               compressors=_mongo_compressors(),
+                                               maxPoolSize=50,
+                                               minPoolSize=5,
+                                               maxIdleTimeMS=300_000,
+                                               waitQueueTimeoutMS=2500,
+                                               appname="wanikani_api")
+                atexit.register(cls.mongo_client.close)
+                cls.db = cls.mongo_client["wanikani"]
+        return cls.db
 
     def __init__(self, token: AnyStr):
         self._token = token
-        self._http = urllib3.PoolManager()
+        with self._rate_limiters_lock:
+            self.rate_limiter = self._rate_limiters.get(token)
+            if self.rate_limiter is None:
+                self.rate_limiter = self._rate_limiters[token] = RateLimiter()
+        # Copied for every GET so the per-url validators can be added to it
+        self._base_headers = {
+            "Authorization": f"Bearer {token}",
+            "Wanikani-Revision": API_REVISION,
+            "Accept-Encoding": ACCEPT_ENCODING
+        }
+        # Validators by url, filled with all of the user's stored ETags on
+        # first use so that no request waits for an ETag lookup
+        self._etag_cache = {}
+        self._etags_loaded = False
+        # ETag of the user response this handle's _user came from
+        self._user_etag = None
+        self.db = self._get_db()
         self._etag_db = self.db["ETag"]
         self._subject_cache = self.db["subjects"]
-        users_db = self.db["users"]
-        user = users_db.find_one({"tokens": {"$in": [token]}})
-        if user is not None:
-            self._user = user
-        else:
-            self._user = self.get_user()
-        self._personal_cache = self.db[self._user["_id"]]
+        self._users_db = self.db["users"]
+        self._ensure_indexes()
+        user = self._cached_user()
+        if user is None:
+            user = self._users_db.find_one({"tokens": {"$in": [token]}})
+            self._remember_user(user)
+        self._user = user if user is not None else self.get_user()
+        self._personal_cache = self._personal_caches.get(self._user["_id"])
+        if self._personal_cache is None:
+            self._personal_cache = self._personal_caches[self._user["_id"]] = self.db[self._user["_id"]]
+        self._ensure_personal_indexes()
+        self._summary = None
+        self._summary_expires = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        # The connection pool is shared between handles so it is left open
+        self._summary = None
 
     def get_assignments(self,
                         *,
-                        ids: Union[int, Iterable, None] = None,
-                        available_after: Union[datetime, str, None] = None,
-                        available_before: Union[datetime, str, None] = None,
+                        ids: IdArg = None,
+                        available_after: DateArg = None,
+                        available_before: DateArg = None,
                         burned: Union[bool, None] = None,
                         hidden: Union[bool, None] = None,
                         immediately_available_for_lessons: Union[bool, None] = None,
@@ -99,60 +374,63 @@ class UserHandle:
                         subject_ids: Union[List[int], None] = None,
                         subject_types: Union[List[str], None] = None,
                         unlocked: Union[bool, None] = None,
-                        updated_after: Union[datetime, str, None] = None):
-        local_args = locals()
-        return self._complex_request("assignment", **{k: local_args[k] for k in self.get_assignments.__kwdefaults__})
-
-    def start_assignment(self, sid: int, started_at: Union[datetime, str, None] = None):
+                        updated_after: DateArg = None):
+        return self._complex_request("assignment",
+                                     ids=ids,
+                                     available_after=available_after,
+                                     available_before=available_before,
+                                     burned=burned,
+                                     hidden=hidden,
+                                     immediately_available_for_lessons=immediately_available_for_lessons,
+                                     immediately_available_for_review=immediately_available_for_review,
+                                     in_review=in_review,
+                                     levels=levels,
+                                     srs_stages=srs_stages,
+                                     started=started,
+                                     subject_ids=subject_ids,
+                                     subject_types=subject_types,
+                                     unlocked=unlocked,
+                                     updated_after=updated_after)
+
+    def start_assignment(self, sid: int, started_at: DateArg = None):
         data = {}
         if started_at is not None:
-            if type(started_at) is str:
-                started_at = datetime.fromisoformat(started_at)
-            data["started_at"] = started_at.isoformat()
-
-        url = f"https://api.wanikani.com/v2/assignments/{sid}/start"
-        if not self.rate_limiter.can_request():
-            raise WanikaniRateLimitError()
-        request = self._http.request(
-            "PUT",
-            url,
-            body=json.dumps(data).encode("utf-8"),
-            headers={
-                "Authorization": f"Bearer {self._token}",
-                'Content-Type': 'application/json; charset=utf-8'
-            }
-        )
-        d = json.loads(request.data.decode("utf-8"))
-        if request.status >= 400:
-            _raise_error(request)
+            data["started_at"] = _to_dt(started_at).isoformat()
 
+        d = self._send("PUT", f"https://api.wanikani.com/v2/assignments/{sid}/start", data)
         self._personal_cache.update_one({"id": sid, "object": "assignment"}, {"$set": d})
+        self._summary = None
         return d
 
     def get_level_progressions(self,
-                               ids: [int, Iterable, None] = None,
-                               updated_after: Union[datetime, str, None] = None):
+                               ids: IdArg = None,
+                               updated_after: DateArg = None):
         request_type = "level_progression"
         return self._ids_updated_after_request(ids, updated_after, request_type)
 
-    def get_resets(self, ids: [int, Iterable, None] = None, updated_after: Union[datetime, str, None] = None):
+    def get_resets(self, ids: IdArg = None, updated_after: DateArg = None):
         return self._ids_updated_after_request(ids, updated_after, "reset")
 
     def get_reviews(self,
                     *,
-                    ids: Union[int, Iterable, None] = None,
+                    ids: IdArg = None,
                     assignment_ids: Union[List[int], None] = None,
                     subject_ids: Union[List[int], None] = None,
-                    updated_after: Union[datetime, str, None] = None):
-        local_args = locals()
-        return self._complex_request("review", **{k: local_args[k] for k in self.get_reviews.__kwdefaults__})
+                    updated_after: DateArg = None):
+        return self._complex_request("review",
+                                     ids=ids,
+                                     assignment_ids=assignment_ids,
+                                     subject_ids=subject_ids,
+                                     updated_after=updated_after)
 
     def create_review(self,
                       incorrect_meaning_answers: int,
                       incorrect_reading_answers: int,
                       aid: Union[int, None] = None,
                       sid: Union[int, None] = None,
-                      created_at: Union[datetime, str, None] = None):
+                      created_at: DateArg = None,
+                      *,
+                      wait_for_rate_limit: bool = False):
         assert aid is not None or sid is not None
         assert aid is None or sid is None
         data = {
@@ -164,62 +442,69 @@ class UserHandle:
         else:
             data["subject_id"] = sid
         if created_at is not None:
-            if type(created_at) is str:
-                created_at = datetime.fromisoformat(created_at)
-            data["started_at"] = created_at.isoformat()
-
-        if not self.rate_limiter.can_request():
-            raise WanikaniRateLimitError()
-        request = self._http.request(
-            "POST",
-            "https://api.wanikani.com/v2/reviews/",
-            body=json.dumps(data).encode("utf-8"),
-            headers={
-                "Authorization": f"Bearer {self._token}",
-                'Content-Type': 'application/json; charset=utf-8'
-            }
-        )
+            data["created_at"] = _to_dt(created_at).isoformat()
 
-        if request.status >= 400:
-            _raise_error(request)
-
-        d = json.loads(request.data.decode("utf-8"))
+        d = self._send("POST", "https://api.wanikani.com/v2/reviews/", data, wait_for_rate_limit)
         assignment = d["resources_updated"]["assignment"]
         review_statistic = d["resources_updated"]["review_statistic"]
         temp = {k: d[k] for k in d if k != "resources_updated"}
-        self._personal_cache.insert_one(temp)
-        self._personal_cache.update_one({"id": assignment["id"],
-                                         "object": "assignment"}, {"$set": assignment})
-        self._personal_cache.update_one({"id": review_statistic["id"],
-                                         "object": "review_statistic"}, {"$set": review_statistic})
+        self._personal_cache.bulk_write([
+            InsertOne(temp),
+            UpdateOne({"id": assignment["id"], "object": "assignment"}, {"$set": assignment}, upsert=True),
+            UpdateOne({"id": review_statistic["id"], "object": "review_statistic"}, {"$set": review_statistic},
+                      upsert=True),
+        ], ordered=False)
+        self._summary = None
         return d
 
+    def create_reviews(self, reviews: Iterable[Dict]) -> List[Dict]:
+        # Reviews are usually submitted in a burst at the end of a session so
+        # instead of failing when the rate limit is hit this waits for it
+        results = []
+        try:
+            for review in reviews:
+                results.append(self.create_review(**review, wait_for_rate_limit=True))
+        except WanikaniApiBaseException as e:
+            # The reviews sent before the failure were created, so they are
+            # handed back with the error for the caller to know what to resend
+            e.results = results
+            raise
+        return results
+
     def get_review_statistics(self,
                               *,
-                              ids: Union[int, Iterable, None] = None,
+                              ids: IdArg = None,
                               hidden: Union[bool, None] = None,
                               percentages_greater_than: Union[int, None] = None,
                               percentages_less_than: Union[int, None] = None,
                               subject_ids: Union[List[int], None] = None,
                               subject_types: Union[List[str], None] = None,
-                              updated_after: Union[datetime, str, None] = None):
-        local_args = locals()
+                              updated_after: DateArg = None):
         return self._complex_request("review_statistic",
-                                     **{k: local_args[k] for k in self.get_review_statistics.__kwdefaults__})
-
-    def get_srs_systems(self, ids: Union[int, Iterable, None] = None, updated_after: Union[datetime, str, None] = None):
+                                     ids=ids,
+                                     hidden=hidden,
+                                     percentages_greater_than=percentages_greater_than,
+                                     percentages_less_than=percentages_less_than,
+                                     subject_ids=subject_ids,
+                                     subject_types=subject_types,
+                                     updated_after=updated_after)
+
+    def get_srs_systems(self, ids: IdArg = None, updated_after: DateArg = None):
         return self._ids_updated_after_request(ids, updated_after, "spaced_repetition_system")
 
     def get_study_materials(self,
                             *,
-                            ids: Union[int, Iterable, None] = None,
+                            ids: IdArg = None,
                             hidden: Union[bool, None] = None,
                             subject_ids: Union[List[int], None] = None,
                             subject_types: Union[List[str], None] = None,
-                            updated_after: Union[datetime, str, None] = None):
-        local_args = locals()
+                            updated_after: DateArg = None):
         return self._complex_request("study_material",
-                                     **{k: local_args[k] for k in self.get_study_materials.__kwdefaults__})
+                                     ids=ids,
+                                     hidden=hidden,
+                                     subject_ids=subject_ids,
+                                     subject_types=subject_types,
+                                     updated_after=updated_after)
 
     def create_study_material(self,
                               sid: int,
@@ -228,27 +513,12 @@ class UserHandle:
                               reading_note: Union[str, None] = None,
                               meaning_synonyms: Union[List[str], None] = None
                               ):
-        data = {
-            "subject_id": sid
-        }
-        for k in self.create_study_material.__kwdefaults__:
-            if (val := locals()[k]) is not None:
-                data[k] = val
+        data = _without_none(subject_id=sid,
+                             meaning_note=meaning_note,
+                             reading_note=reading_note,
+                             meaning_synonyms=meaning_synonyms)
 
-        if not self.rate_limiter.can_request():
-            raise WanikaniRateLimitError()
-        request = self._http.request(
-            "POST",
-            "https://api.wanikani.com/v2/study_materials/",
-            body=json.dumps(data).encode("utf-8"),
-            headers={
-                "Authorization": f"Bearer {self._token}",
-                'Content-Type': 'application/json; charset=utf-8'
-            }
-        )
-        if request.status >= 400:
-            _raise_error(request)
-        d = json.loads(request.data.decode("utf-8"))
+        d = self._send("POST", "https://api.wanikani.com/v2/study_materials/", data)
 
         self._personal_cache.insert_one(d)
         return d
@@ -258,25 +528,11 @@ class UserHandle:
                               meaning_note: Union[str, None] = None,
                               reading_note: Union[str, None] = None,
                               meaning_synonyms: Union[List[str], None] = None):
-        data = {}
-        for k in self.update_study_material.__kwdefaults__:
-            if (val := locals()[k]) is not None:
-                data[k] = val
+        data = _without_none(meaning_note=meaning_note,
+                             reading_note=reading_note,
+                             meaning_synonyms=meaning_synonyms)
 
-        if not self.rate_limiter.can_request():
-            raise WanikaniRateLimitError()
-        request = self._http.request(
-            "PUT",
-            f"https://api.wanikani.com/v2/study_materials/{sid}",
-            body=json.dumps(data).encode("utf-8"),
-            headers={
-                "Authorization": f"Bearer {self._token}",
-                'Content-Type': 'application/json; charset=utf-8'
-            }
-        )
-        if request.status >= 400:
-            _raise_error(request)
-        d = json.loads(request.data.decode("utf-8"))
+        d = self._send("PUT", f"https://api.wanikani.com/v2/study_materials/{sid}", data)
 
         self._personal_cache.update_one({"id": sid,
                                          "object": "study_material"}, {"$set": d})
@@ -284,167 +540,110 @@ class UserHandle:
 
     def get_subjects(self,
                      *,
-                     ids: Union[int, Iterable, None] = None,
+                     ids: IdArg = None,
                      types: Union[List[str], None] = None,
                      slugs: Union[List[str], None] = None,
                      levels: Union[List[int], None] = None,
                      hidden: Union[bool, None] = None,
-                     updated_after: Union[datetime, str, None] = None):
+                     updated_after: DateArg = None):
+        # Only the ids go into the url, the other filters are applied to the
+        # cache. A filtered delta would never return a subject that changed
+        # out of the filter, and its cached copy would keep matching.
         url_params = []
-        filter_args = {
-            "object": {"$in": ["kanji", "vocabulary", "radical"] if types is None else types}
-        }
-        if types is not None:
-            url_params.append(f"types={','.join(types)}")
+        all_types = {"object": {"$in": ["kanji", "vocabulary", "radical"]}}
+        filter_args = {"object": all_types["object"] if types is None else {"$in": types}}
         if levels is not None:
-            url_params.append(f"levels={','.join([str(x) for x in levels])}")
             filter_args["data.level"] = {"$in": levels}
         if ids is not None:
-            temp = ids
-            if type(ids) is int:
-                temp = [ids]
-            url_params.append(f"ids={','.join([str(x) for x in temp])}")
+            temp = _coerce_ids(ids)
+            url_params.append(("ids", ','.join(map(str, temp))))
             filter_args["id"] = {"$in": temp}
         if slugs is not None:
-            url_params.append(f"slugs={','.join(slugs)}")
             filter_args["data.slug"] = {"$in": slugs}
         if hidden is not None:
-            url_params.append(f"hidden={str(hidden).lower()}")
             filter_args["data.hidden_at"] = None if not hidden else {"$ne": None}
         if updated_after is not None:
-            if type(updated_after) is str:
-                updated_after = datetime.fromisoformat(updated_after)
-            url_params.append(f"updated_after={quote(updated_after.isoformat())}")
-            filter_args["data_updated_at"] = {"$gte": updated_after}
+            filter_args["data_updated_at"] = {"$gte": _to_dt(updated_after)}
 
-        is_singular = type(ids) is int and len(url_params) == 1
+        is_singular = type(ids) is int and len(filter_args) == 2 and types is None
 
-        params_string = '&'.join(url_params)
         if is_singular:
-            url_without_update_date = f"https://api.wanikani.com/v2/subjects/{ids}"
-        else:
-            url_without_update_date = f"https://api.wanikani.com/v2/subjects{'?' if url_params else ''}{params_string}"
-
-        updated_after = self._personal_cache.find_one({
-            "object": "url_update",
-            "url": url_without_update_date
-        })
-        if updated_after:
-            url_params.append(f"updated_after={quote(updated_after['date'].isoformat())}")
-
-        if not is_singular:
-            params_string = '&'.join(url_params)
-            url = f"https://api.wanikani.com/v2/subjects{'?' if url_params else ''}{params_string}"
-            cached = self._subject_cache.find(filter_args)
+            url = url_without_update_date = f"https://api.wanikani.com/v2/subjects/{ids}"
+            # An equality on id instead of the $in built for the url parameter
+            load_cached = partial(self._find_subject, ids, url, {"object": filter_args["object"], "id": ids})
         else:
-            url = f"https://api.wanikani.com/v2/subjects/{ids}"
-            cached = self._subject_cache.find_one(filter_args)
-
-        data_out = []
-        while url:
-            headers = {"Authorization": f"Bearer {self._token}"}
-            if (etags := self._etag_db.find_one({"url": url})) is not None:
-                headers["If-Modified-Since"] = etags["Last-Modified"]
-                headers["If-None-Match"] = etags["ETag"]
-
-            if not self.rate_limiter.can_request():
-                self.rate_limiter.sleep_until_can_request()
-            request = self._http.request(
-                "GET",
-                url,
-                headers=headers
-            )
-
-            if request.status >= 400:
-                _raise_error(request.status)
-
-            # Technically this could cause issues if the first url would not have 304
-            # but the second does have, but I don't think that is a feasible case in
-            # real world. Like the API should return 200 for all the data.
-            if request.status == 304:
-                return cached
-
-            data = json.loads(request.data.decode("utf-8"))
-
-            try:
-                last_modified = request.headers["Last-Modified"]
-                etag = request.headers["ETag"]
-                self._etag_db.update_one(
-                    {"url": url},
-                    {"$set": {"url": url, "Last-Modified": last_modified, "ETag": etag}},
-                    upsert=True
-                )
-            except KeyError:
-                pass
-
-            if "pages" in data:
-                data_out.extend(data["data"])
-                url = data["pages"]["next_url"]
-            else:
-                self._convert_dates(data)
-                self._subject_cache.update_one({"object": data["object"], "id": data["id"]},
-                                               {"$set": data},
-                                               upsert=True)
-                return data
-        for item in data_out:
-            self._convert_dates(item)
-            self._subject_cache.update_one({"object": item["object"], "id": item["id"]},
-                                           {"$set": item},
-                                           upsert=True)
-        self._personal_cache.update_one(
-            {"object": "url_update"},
-            {"$set": {
-                "object": "url_update",
-                "url": url_without_update_date,
-                "date": datetime.utcnow()
-            }},
-            upsert=True)
-
-        return data_out
+            url_without_update_date = _build_url("https://api.wanikani.com/v2/subjects", tuple(url_params))
+            self._add_url_update_param(url_without_update_date, url_params)
+            url = _build_url("https://api.wanikani.com/v2/subjects", tuple(url_params))
+            load_cached = partial(self._subject_cache.find, filter_args, {"_id": 0}, batch_size=CACHE_BATCH_SIZE)
+
+        # Only the changed subjects are fetched, the rest come from the cache
+        return self._paginate(url, url_without_update_date, self._subject_cache, not is_singular,
+                              load_cached, all_types, remember=self._remember_subject)
+
+    def _find_subject(self, sid: int, url: str, filter_args: dict):
+        # Subjects rarely change, so apps looking up the same subjects again and
+        # again are answered from memory after the 304 instead of from Mongo.
+        # The 304 only vouches for the ETag this handle sent, which another
+        # process may have stored along with a newer subject, so the copy in
+        # memory is only used when it came with that same ETag.
+        sent = self._etag_cache.get(url)
+        with self._subject_lru_lock:
+            entry = self._subject_lru.get(sid)
+            if entry is not None and sent is not None and entry[0] == sent["ETag"]:
+                self._subject_lru.move_to_end(sid)
+                return copy.deepcopy(entry[1])
+        return self._subject_cache.find_one(filter_args, {"_id": 0})
+
+    def _remember_subject(self, subject: dict, etag: Union[str, None]):
+        if etag is None:
+            return
+        # Stored as a copy so callers mutating their result can't change it
+        entry = (etag, copy.deepcopy(subject))
+        with self._subject_lru_lock:
+            self._subject_lru[subject["id"]] = entry
+            self._subject_lru.move_to_end(subject["id"])
+            if len(self._subject_lru) > SUBJECT_LRU_SIZE:
+                self._subject_lru.popitem(last=False)
 
     def get_summary(self):
+        # Dashboards tend to poll the summary far more often than it changes
+        # The cached report is handed out as a copy so that callers can't
+        # change what later calls return
+        if self._summary is not None and monotonic() < self._summary_expires:
+            return copy.deepcopy(self._summary)
+
         url = "https://api.wanikani.com/v2/summary"
-        headers = self._get_header(url)
         try:
-            request = self._http.request(
-                "GET",
-                url,
-                headers=headers
-            )
+            request = self._conditional_get(url)
         except HTTPError:
             # TODO: parameter for whether it is acceptable for the user
             # to use cached data in case the request failed
-            report = self._personal_cache.find_one({"object": "report"})
+            report = self._personal_cache.find_one({"object": "report"}, {"_id": 0})
             if report:
                 return report
             # TODO: This should be custom error
             raise
 
-        if request.status >= 400:
-            _raise_error(request.status)
-
+        data = None
         if request.status == 304:
-            return self._personal_cache.find_one({"object": "report"})
-
-        data = json.loads(request.data.decode("utf-8"))
-        self._set_etag(url, request.headers)
-
-        self._personal_cache.update_one({"object": "report"}, {"$set": data}, upsert=True)
-        return data
+            data = self._personal_cache.find_one({"object": "report"}, {"_id": 0})
+            if data is None:
+                request = self._conditional_get(url, False)
+        if data is None:
+            data = _loads(request.data)
+            self._set_etag(url, request.headers)
+            self._personal_cache.update_one({"object": "report"}, {"$set": data}, upsert=True)
+
+        self._summary = data
+        self._summary_expires = monotonic() + _summary_ttl(request.headers)
+        return copy.deepcopy(data)
 
     def get_user(self):
-        user_db = self.db["users"]
+        user_db = self._users_db
         url = "https://api.wanikani.com/v2/user"
-        headers = self._get_header(url)
-
-        if not self.rate_limiter.can_request():
-            raise WanikaniRateLimitError()
         try:
-            request = self._http.request(
-                "GET",
-                url,
-                headers=headers
-            )
+            request = self._conditional_get(url)
         except HTTPError:
             # TODO: parameter for whether it is acceptable for the user
             # to use cached data in case the request failed
@@ -454,34 +653,34 @@ class UserHandle:
             # TODO: This should be custom error
             raise
 
-        if request.status >= 400:
-            _raise_error(request.status)
-
         if request.status == 304:
-            return user_db.find_one({"tokens": {"$in": [self._token]}})
-        user_data = json.loads(request.data.decode("utf-8"))
+            # Another handle may have stored the ETag together with a newer user,
+            # so the loaded user is only current if it came with that ETag
+            sent = self._etag_cache.get(url)
+            if sent is not None and sent["ETag"] == self._user_etag:
+                user = self._user
+            else:
+                user = user_db.find_one({"tokens": {"$in": [self._token]}})
+            self._remember_user(user)
+            return user
+        user_data = _loads(request.data)
         self._set_etag(url, request.headers, user_data["data"]["id"])
 
         uid = user_data["data"]["id"]
-        user = user_db.find_one({"_id": uid})
 
         # Since one user can have multiple tokens, it is better
         # to keep track of the tokens the user has so that we can
         # cache data based on the user and not the token
-        if user is not None:
-            if self._token not in user["tokens"]:
-                user_db.update_one({"_id": uid}, {"$push": {"tokens": self._token}})
-            else:
-                # The data was updated
-                user_data["tokens"] = user["tokens"]
-                user_data["_id"] = uid
-                user_db.replace_one({"_id": uid}, user_data)
-        else:
-            user = user_data
-            user["_id"] = uid
-            user["tokens"] = [self._token]
-            user_db.insert_one(user)
+        user = user_db.find_one_and_update(
+            {"_id": uid},
+            {"$set": user_data, "$addToSet": {"tokens": self._token}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
 
+        self._user = user
+        self._user_etag = request.headers.get("ETag")
+        self._remember_user(user)
         return user
 
     def update_user(self,
@@ -493,95 +692,187 @@ class UserHandle:
                     reviews_autoplay_audio: Union[bool, None] = None,
                     reviews_display_srs_indicator: Union[bool, None] = None
                     ):
-        temp_locals = locals()
-        data = {k: temp_locals[k] for k in self.update_user.__kwdefaults__ if temp_locals[k] is not None}
-
-        if not self.rate_limiter.can_request():
-            raise WanikaniRateLimitError()
-        request = self._http.request(
-            "PUT",
-            f"https://api.wanikani.com/v2/user",
-            body=json.dumps(data).encode("utf-8"),
-            headers={
-                "Authorization": f"Bearer {self._token}",
-                'Content-Type': 'application/json; charset=utf-8'
-            }
-        )
-
-        if request.status >= 400:
-            _raise_error(request.status)
+        data = _without_none(default_voice_actor_id=default_voice_actor_id,
+                             lessons_autoplay_audio=lessons_autoplay_audio,
+                             lessons_batch_size=lessons_batch_size,
+                             lessons_presentation_order=lessons_presentation_order,
+                             reviews_autoplay_audio=reviews_autoplay_audio,
+                             reviews_display_srs_indicator=reviews_display_srs_indicator)
 
-        d = json.loads(request.data.decode("utf-8"))
+        d = self._send("PUT", "https://api.wanikani.com/v2/user", data)
+        self._user_by_token.pop(self._token, None)
 
         self._personal_cache.update_one({"_id": d["data"]["id"],
                                          "object": "user"}, {"$set": d})
         return d
 
     def get_voice_actors(self,
-                         ids: Union[int, Iterable, None] = None,
-                         updated_after: Union[datetime, str, None] = None):
+                         ids: IdArg = None,
+                         updated_after: DateArg = None):
         return self._ids_updated_after_request(ids, updated_after, "voice_actor")
 
+    def _cached_user(self):
+        entry = self._user_by_token.get(self._token)
+        if entry is None or entry[1] < monotonic():
+            return None
+        # Every handle of the token shares the entry, so each gets its own copy
+        return copy.deepcopy(entry[0])
+
+    def _remember_user(self, user):
+        if user is not None:
+            self._user_by_token[self._token] = (copy.deepcopy(user), monotonic() + USER_TTL)
+
     def _get_etag_for_url(self, url: str, headers: Dict):
         if not hasattr(self, "_user"):
             return
         uid = self._user["_id"]
-        if (data := self._etag_db.find_one({"uid": uid, "url": url})) is not None:
+        if not self._etags_loaded:
+            self._load_etags(uid)
+        data = self._etag_cache.get(url)
+        if data is not None:
             headers["If-Modified-Since"] = data["Last-Modified"]
             headers["If-None-Match"] = data["ETag"]
 
+    def _load_etags(self, uid):
+        cursor = self._etag_db.find(
+            {"uid": uid},
+            {"_id": 0, "url": 1, "Last-Modified": 1, "ETag": 1},
+            batch_size=CACHE_BATCH_SIZE
+        )
+        for data in cursor:
+            self._etag_cache.setdefault(data.pop("url"), data)
+        self._etags_loaded = True
+
     def _set_etag(self, url: str, header: Dict, uid=None):
         uid = uid or self._user["_id"]
         try:
             last_modified = header["Last-Modified"]
             etag = header["ETag"]
+            # Refetches without validators answer 200 with the ones already stored
+            cached = self._etag_cache.get(url)
+            if cached is not None and cached["ETag"] == etag and cached["Last-Modified"] == last_modified:
+                return
             self._etag_db.update_one(
                 {"uid": uid, "url": url},
                 {"$set": {"uid": uid, "url": url, "Last-Modified": last_modified, "ETag": etag}},
                 upsert=True
             )
+            self._etag_cache[url] = {"Last-Modified": last_modified, "ETag": etag}
         except KeyError:
             pass
 
+    def _send(self, method: str, url: str, data: Dict, wait_for_rate_limit: bool = False):
+        if wait_for_rate_limit:
+            self.rate_limiter.sleep_until_can_request()
+        elif not self.rate_limiter.can_request():
+            raise WanikaniRateLimitError()
+        path = _path(url)
+        body = _dumps(data)
+        headers = {
+            "Authorization": f"Bearer {self._token}",
+            "Wanikani-Revision": API_REVISION,
+            'Content-Type': 'application/json; charset=utf-8'
+        }
+        request = self._http.request(method, path, body=body, headers=headers)
+
+        # A rejected request created nothing, so when the caller is willing to
+        # wait it is sent again once the window resets like in _conditional_get
+        reset = request.headers.get("RateLimit-Reset")
+        if wait_for_rate_limit and request.status == 429 and reset is not None:
+            sleep(max(float(reset) - time(), 0))
+            self.rate_limiter.sleep_until_can_request()
+            request = self._http.request(method, path, body=body, headers=headers)
+        if request.status >= 400:
+            _raise_error(request)
+        return _loads(request.data)
+
+    def _ensure_indexes(self):
+        if "ETag" in self._indexed_collections:
+            return
+        self._etag_db.create_indexes([IndexModel([("uid", ASCENDING), ("url", ASCENDING)])])
+        self._subject_cache.create_indexes([
+            IndexModel([("object", ASCENDING), ("id", ASCENDING)]),
+            IndexModel([("object", ASCENDING), ("data_updated_at", ASCENDING)]),
+            IndexModel([("object", ASCENDING), ("data.level", ASCENDING)]),
+        ])
+        self._users_db.create_indexes([IndexModel([("tokens", ASCENDING)])])
+        self._indexed_collections.add("ETag")
+
+    def _ensure_personal_indexes(self):
+        name = self._personal_cache.name
+        if name in self._indexed_collections:
+            return
+        self._personal_cache.create_indexes([
+            IndexModel([("object", ASCENDING), ("id", ASCENDING)]),
+            IndexModel([("object", ASCENDING), ("url", ASCENDING)]),
+            IndexModel([("object", ASCENDING), ("data_updated_at", ASCENDING)]),
+        ])
+        self._indexed_collections.add(name)
+
+    def _conditional_get(self, url: str, revalidate: bool = True):
+        # Sends the stored ETag with the request so that unchanged resources
+        # are answered with an empty 304 instead of the whole body
+        headers = self._get_header(url) if revalidate else self._base_headers
+        path = _path(url)
+
+        self.rate_limiter.sleep_until_can_request()
+        request = self._http.request(
+            "GET",
+            path,
+            headers=headers
+        )
+
+        # The limiter only knows about this process, so the limit can still be
+        # hit when the token is used elsewhere. Wait for the window to reset and
+        # try once more before giving up.
+        if request.status == 429 and (reset := request.headers.get("RateLimit-Reset")) is not None:
+            sleep(max(float(reset) - time(), 0))
+            self.rate_limiter.sleep_until_can_request()
+            request = self._http.request(
+                "GET",
+                path,
+                headers=headers
+            )
+
+        if request.status >= 400:
+            _raise_error(request)
+        return request
+
     def _get_header(self, url):
-        headers = {"Authorization": f"Bearer {self._token}"}
+        headers = self._base_headers.copy()
         self._get_etag_for_url(url, headers)
         return headers
 
     def _ids_updated_after_request(self,
-                                   ids: Union[int, Iterable, None],
-                                   updated_after: Union[datetime, str, None],
+                                   ids: IdArg,
+                                   updated_after: DateArg,
                                    request_type: str):
         is_singular = type(ids) is int and updated_after is None
         if is_singular:
             url = f"https://api.wanikani.com/v2/{request_type}s/{ids}"
-            cached = self._personal_cache.find_one({"object": request_type, "id": ids})
+            load_cached = partial(self._personal_cache.find_one, {"object": request_type, "id": ids}, {"_id": 0})
             url_params = []
         else:
             url_params = []
             filter_args = {"object": request_type}
             if ids is not None:
-                if type(ids) is int:
-                    ids = [int]
-                url_params.append(f"ids={','.join(str(x) for x in ids)}")
-                filter_args["id"] = {"$in", ids}
+                ids = _coerce_ids(ids)
+                url_params.append(("ids", ','.join(map(str, ids))))
+                filter_args["id"] = {"$in": ids}
             if updated_after is not None:
-                if type(updated_after) is str:
-                    updated_after = datetime.fromisoformat(updated_after)
-
-                url_params.append(f"updated_after={quote(updated_after.isoformat())}")
+                updated_after = _to_dt(updated_after)
+                url_params.append(("updated_after", updated_after.isoformat()))
                 filter_args["data_updated_at"] = {"$gte": updated_after}
 
             url = f"https://api.wanikani.com/v2/{request_type}s"
 
-            cached = self._personal_cache.find(filter_args)
+            load_cached = partial(self._personal_cache.find, filter_args, {"_id": 0}, batch_size=CACHE_BATCH_SIZE)
 
-        return self._do_requests(cached, request_type, url, url_params, is_singular)
+        return self._do_requests(load_cached, request_type, url, url_params, is_singular)
 
     def _complex_request(self, request_type, **kwargs):
         url_params = []
         filter_args = {"object": request_type}
-        local_args = locals()
         self._parse_query_parameters(url_params,
                                      filter_args,
                                      request_type == "assignment",
@@ -589,12 +880,11 @@ class UserHandle:
 
         is_singular = "ids" in kwargs and type(kwargs["ids"]) is int and len(url_params) == 1
         if not is_singular:
-            params_string = '&'.join(url_params)
             url = f"https://api.wanikani.com/v2/{request_type}s"
         else:
             url = f"https://api.wanikani.com/v2/{request_type}s/{kwargs['ids']}"
 
-        cached = None
+        load_cached = None
         can_use_cache = ("levels" not in kwargs or kwargs["levels"] is None) and \
                         ("immediately_available_for_lessons" not in kwargs or kwargs[
                             "immediately_available_for_lessons"] is None) and \
@@ -603,148 +893,173 @@ class UserHandle:
                         ("in_review" not in kwargs or kwargs["in_review"] is None)
         if can_use_cache:
             if is_singular:
-                cached = self._personal_cache.find_one(filter_args)
+                load_cached = partial(self._personal_cache.find_one, filter_args, {"_id": 0})
             else:
-                cached = self._personal_cache.find(filter_args)
-
-        return self._do_requests(cached, request_type, url, url_params, is_singular, can_use_cache)
-
-    def _do_requests(self, cached, request_type, base_url, url_params, is_singular, can_use_cache=True):
+                load_cached = partial(self._personal_cache.find, filter_args, {"_id": 0}, batch_size=CACHE_BATCH_SIZE)
+
+        return self._do_requests(load_cached, request_type, url, url_params, is_singular, can_use_cache)
+
+    def _do_requests(self, load_cached, request_type, base_url, url_params, is_singular, can_use_cache=True):
+        # Only the resources changed since the last sync are requested. Every
+        # filter but the ids is left to the cache, as a filtered delta would
+        # never return an object that changed out of the filter, and its
+        # cached copy would keep matching.
+        track_updates = can_use_cache and not is_singular
+        if track_updates:
+            url_params = [(k, v) for k, v in url_params if k == "ids"]
+        url_without_update_date = _build_url(base_url, tuple(url_params))
+        if track_updates:
+            self._add_url_update_param(url_without_update_date, url_params)
+
+        url = _build_url(base_url, tuple(url_params))
+        return self._paginate(url, url_without_update_date, self._personal_cache, track_updates,
+                              load_cached, {"object": request_type}, can_use_cache)
+
+    def _paginate(self, url, url_without_update_date, collection, track_updates, load_cached,
+                  cached_filter, store_etags=True, remember=None):
         data_out = []
-
-        params_string = '&'.join(url_params)
-        url_without_update_date = f"{base_url}{'?' if url_params else ''}{params_string}"
-
-        updated_after = self._personal_cache.find_one({
-            "object": "url_update",
-            "url": url_without_update_date
-        })
-        if updated_after:
-            url_params.append(f"updated_after={quote(updated_after['date'].isoformat())}")
-
-        params_string = '&'.join(url_params)
-        url = f"{base_url}{'?' if url_params else ''}{params_string}"
+        newest = None
+        # Bound once, these are looked up on every page otherwise
+        conditional_get = self._conditional_get
+        set_etag = self._set_etag
+        extend = data_out.extend
+        # Urls walked with their ETags stored, dropped again if the delta date moves
+        fetched = []
         while url:
-            headers = self._get_header(url)
-
-            if not self.rate_limiter.can_request():
-                self.rate_limiter.sleep_until_can_request()
-
-            request = self._http.request(
-                "GET",
-                url,
-                headers=headers
-            )
-
-            if request.status >= 400:
-                _raise_error(request.status)
+            request = conditional_get(url)
 
             # Technically this could cause issues if the first url would not have 304
             # but the second does have, but I don't think that is a feasible case in
             # real world. Like the API should return 200 for all the data.
+            # The cache is only queried here, so that a 200 doesn't pay for it.
             if request.status == 304:
-                return cached
-
-            data = json.loads(request.data.decode("utf-8"))
-            if can_use_cache:
-                self._set_etag(url, request.headers)
+                # Loaded before anything else so that a single subject found in
+                # the LRU doesn't cost a round trip to Mongo
+                cached = load_cached()
+                if isinstance(cached, dict):
+                    return cached
+                if cached is None:
+                    # The ETag outlived the cached object, so it is fetched again
+                    request = conditional_get(url, False)
+                elif (cached := list(cached)) or collection.count_documents(cached_filter, limit=1):
+                    # Only an empty result needs the count, to tell a filter
+                    # matching nothing apart from a cache that is missing
+                    return cached
+                else:
+                    # The ETag outlived the cached objects, so everything is fetched
+                    # again from the first page without the delta date
+                    self._reset_url_update(url_without_update_date)
+                    url = url_without_update_date
+                    data_out.clear()
+                    newest = None
+                    request = conditional_get(url, False)
+
+            data = _loads(request.data)
+            if store_etags:
+                set_etag(url, request.headers)
+                fetched.append(url)
 
             if "pages" in data:
-                data_out.extend(data["data"])
+                extend(data["data"])
                 url = data["pages"]["next_url"]
+                if data["data_updated_at"] and (newest is None or data["data_updated_at"] > newest):
+                    newest = data["data_updated_at"]
             else:
                 self._convert_dates(data)
-                self._personal_cache.update_one({"object": request_type, "id": data["id"]},
-                                                {"$set": data},
-                                                upsert=True)
+                collection.update_one({"object": data["object"], "id": data["id"]},
+                                      {"$set": data},
+                                      upsert=True)
+                if remember is not None:
+                    remember(data, request.headers.get("ETag"))
                 return data
-        for item in data_out:
+        if data_out:
+            self._write_changed(collection, data_out)
+
+        if track_updates and self._set_url_update(url_without_update_date, newest):
+            self._drop_etags(fetched)
+
+        return data_out if load_cached is None else load_cached()
+
+    def _write_changed(self, collection, items: list):
+        # One round trip for the whole sync instead of one per resource.
+        # Objects whose data_updated_at matches the cached copy are unchanged
+        # and left out of the write.
+        stored = {
+            (doc["object"], doc["id"]): doc.get("data_updated_at")
+            for doc in collection.find(
+                {"object": {"$in": list({item["object"] for item in items})},
+                 "id": {"$in": [item["id"] for item in items]}},
+                {"_id": 0, "object": 1, "id": 1, "data_updated_at": 1},
+                batch_size=CACHE_BATCH_SIZE
+            )
+        }
+        ops = []
+        for item in items:
             self._convert_dates(item)
-            self._personal_cache.update_one({"object": request_type, "id": item["id"]},
-                                            {"$set": item},
-                                            upsert=True)
+            key = (item["object"], item["id"])
+            if key not in stored or stored[key] != _to_millis(item["data_updated_at"]):
+                ops.append(UpdateOne({"object": item["object"], "id": item["id"]}, {"$set": item}, upsert=True))
+        if ops:
+            collection.bulk_write(ops, ordered=False)
 
-        self._personal_cache.update_one(
-            {"object": "url_update"},
+    def _add_url_update_param(self, url: str, url_params: list):
+        updated_after = self._personal_cache.find_one({
+            "object": "url_update",
+            "url": url
+        })
+        if updated_after:
+            url_params.append(("updated_after", updated_after['date'].isoformat()))
+
+    def _set_url_update(self, url: str, newest: Union[str, None]) -> bool:
+        # The newest data_updated_at the API returned is stored instead of the
+        # local time so that a skewed local clock can't cause updates to be missed.
+        # If nothing was returned the previous date is still valid.
+        # Returns whether the date moved, which changes the url of the next sync.
+        if newest is None:
+            return False
+        date = _parse_dt(newest)
+        previous = self._personal_cache.find_one_and_update(
+            {"object": "url_update", "url": url},
             {"$set": {
                 "object": "url_update",
-                "url": url_without_update_date,
-                "date": datetime.utcnow()
+                "url": url,
+                "date": date
             }},
+            projection={"_id": 0, "date": 1},
             upsert=True)
+        return previous is None or previous["date"] != _to_millis(date)
+
+    def _drop_etags(self, urls: list):
+        # The ETags of urls carrying a superseded delta date would never be sent
+        # again, so they are removed instead of piling up in the ETag collection
+        if not urls:
+            return
+        self._etag_db.delete_many({"uid": self._user["_id"], "url": {"$in": urls}})
+        for url in urls:
+            self._etag_cache.pop(url, None)
 
-        return data_out if is_singular else cached
+    def _reset_url_update(self, url: str):
+        self._personal_cache.delete_one({"object": "url_update", "url": url})
 
     @staticmethod
     def _parse_query_parameters(url_params: list, filter_params: dict, is_assignment, **kwargs):
+        # One timestamp for the whole query so the lesson and review filters agree
+        now = datetime.now()
         for param, value in kwargs.items():
             if value is None:
                 continue
-            if param == "immediately_available_for_lessons":
-                url_params.append(param)
-                filter_params["data.unlocked_at"] = {"$lte": datetime.now()}
-                filter_params["data.started_at"] = None
-            elif param == "immediately_available_for_review":
-                url_params.append(param)
-                filter_params["data.available_at"] = {"$lte": datetime.now()}
-            elif param == "in_review":
-                url_params.append(param)
-                filter_params["data.available_at"] = {"$ne": None}
-            else:
-                if "before" in param or "after" in param:
-                    if type(value) is str:
-                        value = datetime.fromisoformat(value)
-                    url_params.append(f"{param}={quote(value.isoformat())}")
-
-                    if param == "updated_after":
-                        filter_params["data_updated_at"] = {"$gte": value}
-                    elif all([x in kwargs for x in ["available_before", "updated_after"]]):
-                        after = kwargs["available_after"]
-                        before = kwargs["available_before"]
-                        filter_params["data.available_at"] = {
-                            "$gte": datetime.fromisoformat(after) if type(after) is str else after,
-                            "$lte": datetime.fromisoformat(before) if type(before) is str else before,
-                        }
-                    elif param == "available_after":
-                        filter_params["data.available_at"] = {"$gte": value}
-                    elif param == "available_before":
-                        filter_params["data.available_at"] = {"$lte": value}
-                    continue
-
-                if "percentage" in param:
-                    if "percentages_greater_than" in kwargs and "percentages_less_than" in kwargs:
-                        upper = kwargs["percentages_less_than"]
-                        lower = kwargs["percentages_greater_than"]
-                        filter_params["data.percentage_correct"] = {
-                            "$gt": lower,
-                            "$lt": upper,
-                        }
-                    elif param == "percentages_less_than":
-                        filter_params["data.percentage_correct"] = {"$lt": kwargs["percentages_less_than"], }
-
-                    elif param == "percentages_greater_than":
-                        filter_params["data.percentage_correct"] = {"$gt": kwargs["percentages_greater_than"], }
-                    continue
-
-                if type(value) in [str, int]:
-                    value = [value]
-
-                if type(value) is bool:
-                    url_params.append(f"{param}={str(value).lower()}")
-                    if is_assignment:
-                        filter_params[f"data.{param}_at"] = {"$ne": None} if value else None
-                    else:
-                        filter_params[f"data.{param}"] = value
-                else:
-                    url_params.append(f"{param}={','.join(str(x) for x in value)}")
-                    if param == "ids":
-                        filter_params["id"] = {"$in": value}
-                    elif param != "levels":
-                        filter_params[f"data.{param[0:-1]}"] = {"$in": value}
+            _QUERY_PARAMETER_HANDLERS.get(param, _parse_list_or_flag)(
+                url_params, filter_params, is_assignment, now, param, value, kwargs)
 
     @staticmethod
-    def _convert_dates(obj: dict):
-        obj["data_updated_at"] = datetime.fromisoformat(obj["data_updated_at"].replace("Z", ""))
-        for key, value in obj["data"].items():
-            if key.endswith("_at") and value is not None:
-                obj["data"][key] = datetime.fromisoformat(obj["data"][key].replace("Z", ""))
+    def _convert_dates(obj: dict) -> dict:
+        # Only strings are parsed, so already converted objects pass through
+        if type(updated := obj["data_updated_at"]) is str:
+            obj["data_updated_at"] = _parse_dt(updated)
+        data = obj["data"]
+        keys = _date_keys(obj["object"], data)
+        for key in keys:
+            value = data.get(key)
+            if type(value) is str:
+                data[key] = _parse_dt(value)
+        return obj